@@ -5,13 +5,33 @@
 # export GOOGLE_APPLICATION_CREDENTIALS="/path/to/your/service-account-file.json"
 # note: gcloud cli `gcloud auth login` did not work, but json auth did.
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
 import numpy as np
+from numba import njit
 import seaborn as sns  # seaborn is a data viz library based on matplotlib
 import requests
-import json
+import orjson
+import polars as pl
+
+# Query results are cached in cache/ so re-runs don't hit BigQuery. Pass --refresh to re-download them.
+parser = argparse.ArgumentParser()
+parser.add_argument("--refresh", action="store_true", help="ignore cached query results and re-run the queries")
+args = parser.parse_args()
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
 
 # Set a nice plot style
 sns.set_context("notebook")
@@ -20,6 +40,52 @@ sns.set_style("darkgrid")
 # Create a "Client"
 client = bigquery.Client(project="wellco-408202")
 
+# Create a BigQuery Storage "Client" so query results stream down as Arrow record batches instead of paged JSON (much faster)
+bqstorage_client = bigquery_storage.BigQueryReadClient()
+
+
+# Run a query and get the results as a Pandas DataFrame backed by Arrow (pd.ArrowDtype), so there's no copy into NumPy objects and the date column stays a date
+# The Arrow table is saved as a zstd Feather file named by the hash of the SQL, and read back from there on the next run
+def query_to_dataframe(sql):
+    cache_path = os.path.join(CACHE_DIR, hashlib.sha1(sql.encode()).hexdigest() + ".feather")
+    if args.refresh or not os.path.exists(cache_path):
+        table = client.query(sql).to_arrow(bqstorage_client=bqstorage_client)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        feather.write_feather(table, cache_path, compression="zstd")
+    else:
+        table = feather.read_table(cache_path)
+    # Dictionary-encode state_name in Arrow so pandas gets it as a category right away, not as a column of Python strings
+    if "state_name" in table.column_names:
+        table = table.set_column(
+            table.column_names.index("state_name"), "state_name", pc.dictionary_encode(table["state_name"])
+        )
+    return table.to_pandas(types_mapper=lambda t: None if pa.types.is_dictionary(t) else pd.ArrowDtype(t))
+
+
+# Z-score of each value, (value - mean) / standard deviation, skipping NaNs. Same as the AVG() and STDDEV() OVER windows in SQL
+# (STDDEV is the sample standard deviation), but done in one compiled pass for the sums and one for the output.
+@njit(cache=True)
+def zscore(values):
+    total = 0.0
+    total_sq = 0.0
+    count = 0
+    for x in values:
+        if not np.isnan(x):
+            total += x
+            total_sq += x * x
+            count += 1
+    out = np.full(values.shape[0], np.nan)
+    if count < 2:
+        return out
+    mean = total / count
+    std = np.sqrt((total_sq - count * mean * mean) / (count - 1))
+    if std == 0:  # like NULLIF(..., 0)
+        return out
+    for i in range(values.shape[0]):
+        out[i] = (values[i] - mean) / std
+    return out
+
+
 # Reference to the "us_states" dataset
 dataset_ref = client.dataset("covid19_nyt", project="bigquery-public-data")
 
@@ -42,90 +108,124 @@ assert table.num_rows == 61942
 assert len(table.schema) == 5  # i.e., five columns
 
 # Define the SQL query that creates a column for daily confirmed cases and a column for daily deaths
+# Only New York is analyzed below, so only its rows and the columns that get used are returned
+# The z-scores of these are computed locally below, the SQL version of them is in the README
 query = """
-WITH us_states_day AS (
+WITH ny_day AS (
   SELECT
-      state_name,
       date,
-      confirmed_cases,
-      deaths,
       confirmed_cases - LAG(confirmed_cases) OVER (PARTITION BY state_name ORDER BY date) AS confirmed_cases_day,
       deaths - LAG(deaths) OVER (PARTITION BY state_name ORDER BY date) AS deaths_day
   FROM
      `bigquery-public-data.covid19_nyt.us_states`
+  WHERE state_name = "New York"
 )
 SELECT
       date,
-      state_name,
       confirmed_cases_day,
-      deaths_day,
-      (
-         (confirmed_cases_day - AVG(confirmed_cases_day) OVER (PARTITION BY state_name))
-         / NULLIF(STDDEV(confirmed_cases_day) OVER (PARTITION BY state_name), 0)
-      ) AS confirmed_cases_day_zscore,
-      (
-         (deaths_day - AVG(deaths_day) OVER (PARTITION BY state_name))
-         / NULLIF(STDDEV(deaths_day) OVER (PARTITION BY state_name), 0)
-      ) AS deaths_day_zscore
+      deaths_day
   FROM
-      us_states_day
+      ny_day
   ORDER BY date;
 """
 
-# Run the query and get the results as a Pandas DataFrame
-data = client.query(query).to_dataframe()
-# Convert 'date' column to datetime format
-data["date"] = pd.to_datetime(data["date"])
+# Monthly aggregate deaths in New York. Sum the daily deaths by month in SQL so only one row per month comes back. Negative daily values are clipped to 0 like below.
+monthly_deaths_query = """
+WITH ny_deaths_day AS (
+  SELECT
+      date,
+      deaths - LAG(deaths) OVER (PARTITION BY state_name ORDER BY date) AS deaths_day
+  FROM
+     `bigquery-public-data.covid19_nyt.us_states`
+  WHERE state_name = "New York"
+)
+SELECT
+      FORMAT_DATE("%Y-%m", date) AS month,
+      SUM(GREATEST(deaths_day, 0)) AS deaths_day
+  FROM
+      ny_deaths_day
+  GROUP BY month
+  ORDER BY month;
+"""
+
+# Part 1.c. highest month for each state (used at the end). The GROUP BY in the WITH gives one row per state and month,
+# then the outer GROUP BY takes the max per state
+states_query = """
+WITH monthly AS (
+  SELECT
+      state_name,
+      MAX(confirmed_cases) AS highest_monthly_confirmed_cases
+  FROM 
+      `bigquery-public-data.covid19_nyt.us_states`
+  GROUP BY state_name, EXTRACT(YEAR FROM date), EXTRACT(MONTH FROM date)
+)
+SELECT
+    state_name,
+    MAX(highest_monthly_confirmed_cases) AS highest_monthly_confirmed_cases
+FROM
+    monthly
+GROUP BY state_name
+ORDER BY highest_monthly_confirmed_cases DESC;
+"""
+
+# Start all the queries at once. They don't depend on each other, so BigQuery runs them at the same time and the
+# downloads (I/O bound, so threads are fine) overlap with the New York analysis and plots below
+executor = ThreadPoolExecutor()
+ny_data_future = executor.submit(query_to_dataframe, query)
+monthly_deaths_future = executor.submit(query_to_dataframe, monthly_deaths_query)
+states_highest_future = executor.submit(query_to_dataframe, states_query)
+
+# Get the results as a Pandas DataFrame
+ny_data = ny_data_future.result()
+
+# Z-scores of the daily confirmed cases and deaths
+ny_data["confirmed_cases_day_zscore"] = zscore(
+    ny_data["confirmed_cases_day"].to_numpy(dtype=np.float64, na_value=np.nan)
+)
+ny_data["deaths_day_zscore"] = zscore(
+    ny_data["deaths_day"].to_numpy(dtype=np.float64, na_value=np.nan)
+)
 
 # Check data types
-# print(data.dtypes)
-# date                           dbdate
-# state_name                     object
-# confirmed_cases_day             Int64
-# deaths_day                      Int64
-# confirmed_cases_day_zscore    float64
-# deaths_day_zscore             float64
+# print(ny_data.dtypes)
+# date                          date32[day][pyarrow]
+# confirmed_cases_day               int64[pyarrow]
+# deaths_day                        int64[pyarrow]
+# confirmed_cases_day_zscore               float64
+# deaths_day_zscore                        float64
 
 # Check for missing data
-# print("Null values in dataset", data.isnull().sum())
+# print("Null values in dataset", ny_data.isnull().sum())
 # Null values in dataset
 # date                           0
-# state_name                     0
-# confirmed_cases_day           56
-# deaths_day                    56
-# confirmed_cases_day_zscore    56
-# deaths_day_zscore             56
+# confirmed_cases_day            1
+# deaths_day                     1
+# confirmed_cases_day_zscore     1
+# deaths_day_zscore              1
 
 # Fill null values with 0
-# data = data.fillna(0)
+# ny_data = ny_data.fillna(0)
 
 # Assert there are no negative values in confirmed cases and deaths (not possible)
-# assert data["confirmed_cases_day"].min() >= 0
-# assert data["deaths_day"].min() >= 0
+# assert ny_data["confirmed_cases_day"].min() >= 0
+# assert ny_data["deaths_day"].min() >= 0
 
 # Uh Oh, there are negative values in my calculated daily confirmed cases and deaths. This likely means there were corrections inputted to the data. I will fill these values with 0.
-data["confirmed_cases_day"] = data["confirmed_cases_day"].clip(lower=0)
-data["deaths_day"] = data["deaths_day"].clip(lower=0)
-
-# Filter for New York, sort by date
-ny_data = data[data["state_name"] == "New York"]
-ny_data = ny_data.sort_values(by="date")
+# Done with NumPy on one int64 array per column (the null first day becomes 0 too)
+for col in ["confirmed_cases_day", "deaths_day"]:
+    ny_data[col] = np.maximum(ny_data[col].to_numpy(dtype=np.int64, na_value=0), 0)
 
 # MONTHLY AGGREGATE DEATHS IN NEW YORK
-ny_data["month"] = ny_data["date"].dt.to_period("M")  # Create a month column
-monthly_deaths = (
-    ny_data.groupby("month")["deaths_day"].sum().reset_index()
-)  # Sum deaths by month
+monthly_deaths = monthly_deaths_future.result()
 
 
 ## Plotting monthly deaths
-plt.figure(figsize=(12, 6))
-ax = sns.barplot(
-    x=monthly_deaths["month"].astype(str), 
-    y=monthly_deaths["deaths_day"], 
-    color="#E74C3C"
-)
-ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha="right")
+# The data is already aggregated, so plain matplotlib bars are used instead of sns.barplot (which re-aggregates)
+# The month labels are already "YYYY-MM" strings from SQL, so they're set once along with the ticks
+month_labels = monthly_deaths["month"].tolist()
+fig, ax = plt.subplots(figsize=(12, 6))
+ax.bar(range(len(month_labels)), monthly_deaths["deaths_day"], color="#E74C3C")
+ax.set_xticks(range(len(month_labels)), month_labels, rotation=45, ha="right")
 ax.set_xlabel("Month", fontsize=14)
 ax.set_ylabel("Aggregate Deaths", fontsize=14)
 ax.set_title("Monthly Aggregate Deaths in New York", fontsize=16)
@@ -162,18 +262,11 @@ plt.show()
 
 # Anomaly Detection using IQR
 # Find and label Z-scores that are 3 standard deviations away from the mean
-upper_bound = 3
-lower_bound = -3
-
-# Find outliers
-outliers = ny_data[
-    (ny_data["confirmed_cases_day_zscore"] > upper_bound)
-    | (ny_data["confirmed_cases_day_zscore"] < lower_bound)
-]
-outliers_deaths = ny_data[
-    (ny_data["deaths_day_zscore"] > upper_bound)
-    | (ny_data["deaths_day_zscore"] < lower_bound)
-]
+bound = 3
+
+# Find outliers (|z| > 3 is one comparison instead of > 3, < -3 and an or)
+outliers = ny_data[np.abs(ny_data["confirmed_cases_day_zscore"].to_numpy()) > bound]
+outliers_deaths = ny_data[np.abs(ny_data["deaths_day_zscore"].to_numpy()) > bound]
 
 # Plotting anomalies on top of Z-score plot
 plt.figure(figsize=(12, 6))
@@ -191,15 +284,20 @@ plt.plot(
     color="#E74C3C",
     linewidth=2,
 )
-plt.scatter(
+# Markers only (no line), drawn as one Line2D per series instead of a scatter collection
+plt.plot(
     outliers["date"],
     outliers["confirmed_cases_day_zscore"],
+    "o",
+    linestyle="None",
     color="red",
     label="Anomalies Cases",
 )
-plt.scatter(
+plt.plot(
     outliers_deaths["date"],
     outliers_deaths["deaths_day_zscore"],
+    "o",
+    linestyle="None",
     color="black",
     label="Anomalies Deaths",
 )
@@ -210,11 +308,11 @@ plt.show()
 
 # Outlier Narrative
 # What could be the reasons for those large outliers? Could be errors in reporting.
-# Sort by highest or lowest z-scores for confirmed cases and deaths to see what days they are
-print(ny_data.sort_values(by="confirmed_cases_day_zscore", ascending=False).head())
-print(ny_data.sort_values(by="confirmed_cases_day_zscore", ascending=True).head())
-print(ny_data.sort_values(by="deaths_day_zscore", ascending=False).head())
-print(ny_data.sort_values(by="deaths_day_zscore", ascending=True).head())
+# Get the highest or lowest z-scores for confirmed cases and deaths to see what days they are (no full sort needed for the top 5)
+print(ny_data.nlargest(5, "confirmed_cases_day_zscore"))
+print(ny_data.nsmallest(5, "confirmed_cases_day_zscore"))
+print(ny_data.nlargest(5, "deaths_day_zscore"))
+print(ny_data.nsmallest(5, "deaths_day_zscore"))
 
 # The day 2022-11-11 in NY had a high spike. Why?
 
@@ -222,65 +320,28 @@ print(ny_data.sort_values(by="deaths_day_zscore", ascending=True).head())
 
 ######## PART 1.c. ########
 
-# Do this query, pull out data, and then find the maximum month for each state and plot it.
+# Find the maximum month for each state and plot it. Done in SQL, states_query is at the top with the others.
 
-sql_query = """
-SELECT
-    state_name,
-    date,
-    EXTRACT(YEAR FROM date) AS year,
-    EXTRACT(MONTH FROM date) AS month,
-    MAX(confirmed_cases) OVER (
-        PARTITION BY state_name, EXTRACT(YEAR FROM date), EXTRACT(MONTH FROM date)
-    ) AS highest_monthly_confirmed_cases
-FROM 
-    `bigquery-public-data.covid19_nyt.us_states`;
-"""
-
-data2 = client.query(sql_query).to_dataframe()
-data2["date"] = pd.to_datetime(data2["date"])
-
-print(data2.head())
-
-#   state_name       date  year  month  highest_monthly_confirmed_cases
-# 0    Alabama 2022-08-01  2022      8                          1491815
-# 1    Alabama 2022-08-02  2022      8                          1491815
-# 2    Alabama 2022-08-03  2022      8                          1491815
-# 3    Alabama 2022-08-04  2022      8                          1491815
-# 4    Alabama 2022-08-05  2022      8                          1491815
-
-# It has data like this, but i need to group it by each state
-
-# Get a unique row for each state
-data2 = data2.groupby(["state_name", "year", "month"]).max().reset_index()
-
-# Sort by highest monthly confirmed cases
-data2 = data2.sort_values(by='highest_monthly_confirmed_cases', ascending=False)
-
-states_and_highest_month = {}
-for state in data2["state_name"].unique():
-    state_data = data2[data2["state_name"] == state]
-    highest_month = state_data["highest_monthly_confirmed_cases"].max()
-    states_and_highest_month[state] = highest_month
+states_highest = states_highest_future.result()
+states_and_highest_month = states_highest.set_index("state_name")["highest_monthly_confirmed_cases"]
 
 print(states_and_highest_month)
 
-# plot it w/ state on X, using SNS barplot, w/ a cool palette, comma sep Y values not scientific notation
+# plot it w/ state on X, as a bar chart w/ a cool palette, comma sep Y values not scientific notation
 # Plot the highest monthly confirmed cases by state
 
-# Convert values to a numpy array for colormap normalization
-values = np.array(list(states_and_highest_month.values()))
-# Normalize values for the colormap
-normalized_values = (values - values.min()) / (values.max() - values.min())
+# Convert values to a numpy array for the colormap
+values = states_and_highest_month.to_numpy()
+# Map values to colors, normalized between the min and max (the mappable can be reused for a colorbar too)
+color_mapper = ScalarMappable(
+    norm=Normalize(values.min(), values.max()), cmap=sns.color_palette("rocket", as_cmap=True)
+)
+colors = color_mapper.to_rgba(values)
 
 # Plot the highest monthly confirmed cases by state
-plt.figure(figsize=(15, 8))
-ax = sns.barplot(
-    x=list(states_and_highest_month.keys()), 
-    y=list(states_and_highest_month.values()), 
-    palette=sns.color_palette("rocket", as_cmap=True)(normalized_values)
-)
-ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha="right")
+fig, ax = plt.subplots(figsize=(15, 8))
+ax.bar(range(len(values)), values, color=colors)
+ax.set_xticks(range(len(values)), states_and_highest_month.index.tolist(), rotation=45, ha="right")
 ax.set_xlabel("State", fontsize=14)
 ax.set_ylabel("Highest Monthly Confirmed Cases", fontsize=14)
 ax.set_title("Highest Monthly Confirmed Cases by State", fontsize=16)
@@ -298,30 +359,36 @@ plt.show()
 pop_per_state = requests.get(
     "https://datausa.io/api/data?drilldowns=State&measures=Population"
 )
-pop_per_state = json.loads(pop_per_state.text)
-pop_per_state = pd.DataFrame(pop_per_state["data"])
-pop_per_state = pop_per_state[["State", "Population"]]
-pop_per_state.columns = ["state_name", "population"]
-pop_per_state["population"] = pop_per_state["population"].astype(int)
-
-# Merge population data with highest monthly confirmed cases data, like a table join.
-data2 = data2.merge(pop_per_state, how="left", on="state_name")
-data2["highest_monthly_confirmed_cases_per_capita"] = (
-    data2["highest_monthly_confirmed_cases"] / data2["population"]
+pop_per_state = orjson.loads(pop_per_state.content)  # parse the raw bytes, no decoding to str first
+pop_per_state = pl.LazyFrame(pop_per_state["data"]).select(
+    pl.col("State").alias("state_name"),
+    pl.col("Population").cast(pl.Int64).alias("population"),
 )
 
-# Sort it by that
-data2 = data2.sort_values(by='highest_monthly_confirmed_cases_per_capita', ascending=False)
+# Highest month of each state joined with the population (left join, like a table join) and divided by it, then sorted.
+# Written as one lazy Polars query so it runs as a single optimized plan, without the in between DataFrames.
+per_capita = (
+    pl.from_pandas(states_highest)
+    .lazy()
+    .with_columns(pl.col("state_name").cast(pl.Utf8))
+    .join(pop_per_state, on="state_name", how="left")
+    .with_columns(
+        (pl.col("highest_monthly_confirmed_cases") / pl.col("population")).alias(
+            "highest_monthly_confirmed_cases_per_capita"
+        )
+    )
+    .sort("highest_monthly_confirmed_cases_per_capita", descending=True, nulls_last=True)
+    .collect()
+)
 
 # Plot the highest monthly confirmed cases by state per capita
-plt.figure(figsize=(15, 8))
-ax = sns.barplot(
-    x=data2["state_name"], 
-    y=data2["highest_monthly_confirmed_cases_per_capita"], 
-    palette="viridis", 
-    errwidth=0 # Remove error bars
+fig, ax = plt.subplots(figsize=(15, 8))
+ax.bar(
+    range(len(per_capita)),
+    per_capita["highest_monthly_confirmed_cases_per_capita"].to_numpy(),
+    color=sns.color_palette("viridis", len(per_capita)),
 )
-ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha="right")
+ax.set_xticks(range(len(per_capita)), per_capita["state_name"].to_list(), rotation=45, ha="right")
 ax.set_xlabel("State", fontsize=14)
 ax.set_ylabel("Highest Monthly Confirmed Cases per Capita", fontsize=14)
 ax.set_title("Highest Monthly Confirmed Cases by State per Capita", fontsize=16)